@@ -0,0 +1,93 @@
+import argparse
+import csv
+import json
+import os
+import sys
+from collections import Counter
+
+from db import iter_user_records
+
+EXPORT_FIELDS = ('id', 'state', 'location', 'language', 'units')
+
+
+class UserStats:
+    def __init__(self):
+        self.users = 0
+        self.locations = Counter()
+        self.languages = Counter()
+        self.units = Counter()
+        self.states = Counter()
+
+    def add(self, user_data):
+        self.users += 1
+        self.locations[user_data.settings.location or '(not set)'] += 1
+        self.languages[user_data.settings.language.value] += 1
+        self.units[user_data.settings.units.value] += 1
+        self.states[user_data.state.name.lower()] += 1
+
+    def summary(self, top=10):
+        lines = [f'Users: {self.users}', f'Locations: {len(self.locations)}']
+        for title, counter in (('Top locations', self.locations), ('Languages', self.languages),
+                               ('Units', self.units), ('States', self.states)):
+            lines.append(f'{title}:')
+            lines.extend(f'  {name}: {count}' for name, count in counter.most_common(top))
+        return '\n'.join(lines)
+
+
+def compute_stats(records=None):
+    stats = UserStats()
+    for _, user_data in records if records is not None else iter_user_records():
+        stats.add(user_data)
+    return stats
+
+
+def user_record_to_dict(user_id, user_data):
+    return {
+        'id': user_id,
+        'state': user_data.state.name.lower(),
+        'location': user_data.settings.location,
+        'language': user_data.settings.language.value,
+        'units': user_data.settings.units.value,
+    }
+
+
+def export_users(f, fmt, records=None):
+    """Writes users to the text file f one record at a time, returns the number of users written."""
+    count = 0
+    writer = None
+    if fmt == 'csv':
+        writer = csv.DictWriter(f, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
+    for user_id, user_data in records if records is not None else iter_user_records():
+        row = user_record_to_dict(user_id, user_data)
+        if writer is not None:
+            writer.writerow(row)
+        else:
+            f.write(json.dumps(row, ensure_ascii=False) + '\n')
+        count += 1
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Weather bot user base reports.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    stats_parser = subparsers.add_parser('stats', help='print aggregates over the user base')
+    stats_parser.add_argument('--top', type=int, default=10, help='entries shown per breakdown')
+    export_parser = subparsers.add_parser('export', help='export the user base')
+    export_parser.add_argument('--format', choices=('csv', 'jsonl'), default='csv')
+    export_parser.add_argument('-o', '--output', help='output file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'stats':
+        print(compute_stats().summary(top=args.top))
+    elif args.output is None:
+        export_users(sys.stdout, args.format)
+    else:
+        with open(args.output, mode='w', encoding='utf-8', newline='') as f:
+            count = export_users(f, args.format)
+        sys.stderr.write(f'Exported {count} users to {args.output}.' + os.linesep)
+
+
+if __name__ == '__main__':
+    main()
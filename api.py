@@ -1,11 +1,16 @@
 import os
 import sys
-from collections import Counter
+import threading
+import time
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, tzinfo
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from consts import OWM_API_KEY, API_URL
+from consts import OWM_API_KEY, API_URL, FORECAST_CACHE_TTL, FORECAST_CACHE_SIZE, OWM_CALLS_PER_MINUTE, \
+    OWM_INTERACTIVE_RESERVE, OWM_INTERACTIVE_WAIT, BULK_FETCH_WORKERS, BULK_STOP_POLL_INTERVAL
 from state import LocationData, CurrentWeatherReport, TomorrowWeatherReport, ForecastWeatherReport
 
 
@@ -20,7 +25,46 @@ class SimpleTimezone(tzinfo):
         return timedelta(0)
 
 
+class RateLimiter:
+    """Blocking sliding-window limiter allowing at most limit calls in any period seconds.
+
+    Callers passing reserve only go ahead while that many calls of the window are still free,
+    which keeps them for the callers that don't.
+    """
+
+    def __init__(self, limit, period=60):
+        self.limit = limit
+        self.period = period
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self, reserve=0, timeout=None):
+        """Waits for a free call, returns False if none came up within timeout seconds."""
+        allowed = max(1, self.limit - reserve)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.period:
+                    self._calls.popleft()
+                if len(self._calls) < allowed:
+                    self._calls.append(now)
+                    return True
+                wait = self._calls[len(self._calls) - allowed] + self.period - now
+            if deadline is not None:
+                if now + wait > deadline:
+                    return False
+            time.sleep(wait)
+
+
+# Shared by every OWM call so bulk refreshes and user requests stay within one quota
+owm_quota = RateLimiter(OWM_CALLS_PER_MINUTE)
+
+
 def check_if_location_exists(location):
+    if not owm_quota.acquire(timeout=OWM_INTERACTIVE_WAIT):
+        sys.stderr.write('OWM quota exhausted.' + os.linesep)
+        return None
     try:
         querystring = {'q': location, 'appid': OWM_API_KEY}
         response = requests.get(API_URL, params=querystring)
@@ -30,20 +74,172 @@ def check_if_location_exists(location):
         return response.status_code == 200
 
 
-def request_forecast(location, language, units):
+def request_forecast(location, language, units, session=requests, api_url=API_URL, quota=owm_quota):
+    """Fetches the forecast, giving up if no OWM call frees up within OWM_INTERACTIVE_WAIT seconds.
+
+    Pass quota=None when the call has already been acquired.
+    """
     querystring = {
         'q': location,
         'lang': language.short_name(),
         'units': units.value,
         'appid': OWM_API_KEY,
     }
+    if quota is not None and not quota.acquire(timeout=OWM_INTERACTIVE_WAIT):
+        sys.stderr.write('OWM quota exhausted.' + os.linesep)
+        return None
     try:
-        response = requests.get(API_URL, params=querystring)
+        response = session.get(api_url, params=querystring)
+        if response.status_code == 200:
+            return response.json()
     except Exception as e:
         sys.stderr.write(f"Exception: {e}" + os.linesep)
+    return None
+
+
+# Rendered messages live in their forecast's entry, so they expire and get evicted together with it
+ForecastCacheEntry = namedtuple('ForecastCacheEntry', 'fetched_at response rendered')
+
+# (location, language, units) -> ForecastCacheEntry, oldest first
+_forecast_cache = {}
+_forecast_cache_lock = threading.Lock()
+
+
+def forecast_cache_key(location, language, units):
+    return location.strip().lower(), language, units
+
+
+def get_cached_forecast_entry(location, language, units):
+    entry = _forecast_cache.get(forecast_cache_key(location, language, units))
+    if entry is not None and time.monotonic() - entry.fetched_at < FORECAST_CACHE_TTL:
+        return entry
+    return None
+
+
+def request_forecast_entry(location, language, units):
+    entry = get_cached_forecast_entry(location, language, units)
+    if entry is not None:
+        return entry
+    response = request_forecast(location, language, units)
+    if response is None:
         return None
-    if response.status_code == 200:
-        return response.json()
+    return store_forecast(location, language, units, response)
+
+
+def store_forecast(location, language, units, response):
+    entry = ForecastCacheEntry(fetched_at=time.monotonic(), response=response, rendered={})
+    key = forecast_cache_key(location, language, units)
+    with _forecast_cache_lock:
+        _forecast_cache.pop(key, None)
+        _forecast_cache[key] = entry
+        while len(_forecast_cache) > FORECAST_CACHE_SIZE:
+            del _forecast_cache[next(iter(_forecast_cache))]
+    return entry
+
+
+def get_cached_forecast(location, language, units):
+    entry = get_cached_forecast_entry(location, language, units)
+    return entry.response if entry is not None else None
+
+
+def request_forecast_cached(location, language, units):
+    entry = request_forecast_entry(location, language, units)
+    return entry.response if entry is not None else None
+
+
+def get_forecast_cache_entries():
+    with _forecast_cache_lock:
+        return list(_forecast_cache.values())
+
+
+_render_cache_hits = 0
+_render_cache_misses = 0
+
+
+def get_rendered(entry, key, render, size):
+    """Returns render(entry.response), rendered once and kept in the entry under key along with its size."""
+    global _render_cache_hits, _render_cache_misses
+    with _forecast_cache_lock:
+        cached = entry.rendered.get(key)
+        if cached is not None:
+            _render_cache_hits += 1
+            return cached[0]
+        _render_cache_misses += 1
+    rendered = render(entry.response)
+    if rendered is not None:
+        rendered_size = size(rendered)
+        with _forecast_cache_lock:
+            entry.rendered[key] = (rendered, rendered_size)
+    return rendered
+
+
+def get_render_cache_stats():
+    with _forecast_cache_lock:
+        sizes = [rendered_size for entry in _forecast_cache.values()
+                 for _, rendered_size in entry.rendered.values()]
+        hits, misses = _render_cache_hits, _render_cache_misses
+    return {'entries': len(sizes), 'bytes': sum(sizes), 'hits': hits, 'misses': misses}
+
+
+def request_forecasts(locations, language, units, workers=BULK_FETCH_WORKERS, api_url=API_URL, quota=owm_quota):
+    """Yields (location, response) for many locations as soon as each forecast is available.
+
+    Cached forecasts come first, the rest are fetched concurrently over pooled connections under
+    the shared OWM quota, leaving OWM_INTERACTIVE_RESERVE calls a minute to user requests, and stored
+    in the cache. Each location is fetched once however it's spelled;
+    response is None if the fetch failed.
+    """
+    seen = set()
+    missing = []
+    for location in locations:
+        key = forecast_cache_key(location, language, units)
+        if key in seen:
+            continue
+        seen.add(key)
+        response = get_cached_forecast(location, language, units)
+        if response is not None:
+            yield location, response
+        else:
+            missing.append(location)
+    if not missing:
+        return
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    stop = threading.Event()
+    futures = {
+        executor.submit(
+            _request_forecast_for_bulk, stop, location, language, units, session, api_url, quota
+        ): location
+        for location in missing
+    }
+    try:
+        for future in as_completed(futures):
+            location = futures[future]
+            try:
+                response = future.result()
+            except Exception as e:
+                sys.stderr.write(f"Exception: {e}" + os.linesep)
+                response = None
+            if response is not None:
+                store_forecast(location, language, units, response)
+            yield location, response
+    finally:
+        # when the caller stops early, don't wait for fetches still queued for the quota
+        stop.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        session.close()
+
+
+def _request_forecast_for_bulk(stop, location, language, units, session, api_url, quota):
+    while not stop.is_set():
+        if quota.acquire(OWM_INTERACTIVE_RESERVE, timeout=BULK_STOP_POLL_INTERVAL):
+            return request_forecast(location, language, units, session, api_url, quota=None)
     return None
 
 
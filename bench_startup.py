@@ -0,0 +1,103 @@
+"""Startup benchmark: cold start through polling and through the first update served.
+
+Every run is a fresh interpreter started the way weather_bot.py starts, against a
+local DB seeded with a generated user base. Telegram API calls are stubbed, so only
+imports, state loading and handler dispatch are measured.
+
+Usage: python bench_startup.py [runs] [users]
+"""
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from consts import LOCAL_DB_PATH
+from state import State, Language, Units, Settings, UserData, serialize
+
+CITIES = ('London', 'Moscow', 'San Jose', 'Berlin', 'Paris', 'Tokyo', 'Saint Petersburg', 'New York', 'Kyiv', 'Minsk')
+
+CHILD = '''
+import threading
+import time
+
+t0 = time.perf_counter()
+from db import states
+states.start_loading()
+import handlers
+from telebot import types as tt
+handlers.bot.polling = lambda *args, **kwargs: None
+handlers.start_polling()
+t_polling = time.perf_counter() - t0
+
+served = threading.Event()
+handlers.bot.reply_to = lambda *args, **kwargs: served.set()
+update = tt.Update.de_json({
+    'update_id': 1,
+    'message': {
+        'message_id': 1,
+        'from': {'id': -1, 'is_bot': False, 'first_name': 'Bench'},
+        'chat': {'id': -1, 'type': 'private'},
+        'date': 0,
+        'text': 'hi',
+    },
+})
+handlers.bot.process_new_updates([update])
+served.wait(60)
+t_first = time.perf_counter() - t0
+print(f'{t_polling} {t_first}')
+'''
+
+
+def seed_local_db(path, users):
+    states = {
+        user_id: UserData(
+            state=random.choice((State.MAIN, State.SETTINGS)),
+            settings=Settings(
+                location=random.choice(CITIES),
+                language=random.choice(list(Language)),
+                units=random.choice(list(Units))
+            )
+        )
+        for user_id in range(1, users + 1)
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode='w', encoding='utf-8') as f:
+        f.write(serialize(states))
+
+
+def run_once(workdir):
+    env = dict(os.environ)
+    env.setdefault('BOT_TOKEN', '123456:bench')
+    env.pop('REDIS_URL', None)
+    env['PYTHONPATH'] = os.path.dirname(os.path.abspath(__file__))
+    start = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, '-c', CHILD],
+        cwd=workdir,
+        env=env,
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True
+    ).stdout
+    total = time.perf_counter() - start
+    t_polling, t_first = (float(x) for x in out.split()[-2:])
+    return t_polling, t_first, total
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    with tempfile.TemporaryDirectory() as workdir:
+        seed_local_db(os.path.join(workdir, LOCAL_DB_PATH), users)
+        results = [run_once(workdir) for _ in range(runs)]
+    print(f'{users} users, {runs} runs')
+    for name, i in (('polling started', 0), ('first update served', 1), ('process wall time', 2)):
+        samples = [r[i] * 1000 for r in results]
+        print(f'{name:>20}: median {statistics.median(samples):8.1f} ms, max {max(samples):8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,6 @@ import os
 from enum import Enum
 
 from dotenv import load_dotenv, find_dotenv
-from telebot import types as tt
 
 from state import Units, Language
 
@@ -12,9 +11,26 @@ load_dotenv(find_dotenv())
 TOKEN = os.getenv('BOT_TOKEN')
 OWM_API_KEY = os.getenv('OWM_API_KEY')
 REDIS_URL = os.getenv('REDIS_URL')
+OWM_CALLS_PER_MINUTE = int(os.getenv('OWM_CALLS_PER_MINUTE', '60'))
+OWM_INTERACTIVE_RESERVE = OWM_CALLS_PER_MINUTE // 4  # calls a minute bulk fetching leaves to user requests
+OWM_INTERACTIVE_WAIT = 2  # seconds a user request waits for the quota before giving up
+ADMIN_IDS = {int(id_) for id_ in os.getenv('ADMIN_IDS', '').split(',') if id_.strip()}
 
 API_URL = 'https://api.openweathermap.org/data/2.5/forecast'
 LOCAL_DB_PATH = 'db/data'
+REDIS_USERS_KEY = 'users'  # hash of user id -> serialized user
+REDIS_LEGACY_KEY = 'data'  # all users in one string, migrated to REDIS_USERS_KEY on load
+REDIS_SCAN_COUNT = 1000
+
+FORECAST_CACHE_TTL = 10 * 60  # seconds, OWM forecast data only changes every 3 hours
+FORECAST_CACHE_SIZE = 5000
+POPULAR_LOCATIONS_UPDATE_INTERVAL = 10 * 60
+POPULAR_LOCATIONS_WARM_UP = 20  # most popular locations kept cached for inline queries
+INLINE_CACHE_TIME = 5 * 60  # passed to Telegram as cache_time
+INLINE_DEBOUNCE_DELAY = 0.7  # seconds to wait for the user to stop typing before calling OWM
+INLINE_MAX_RESULTS = 5
+BULK_FETCH_WORKERS = 8
+BULK_STOP_POLL_INTERVAL = 0.5  # seconds between stop checks of bulk fetches waiting for the quota
 
 DEGREE_SIGNS = {Units.METRIC: '℃', Units.IMPERIAL: '℉'}
 LANGUAGE_SIGNS = {Language.ENGLISH: '🇺🇸', Language.RUSSIAN: '🇷🇺'}
@@ -97,9 +113,10 @@ SETTING_UNITS_KEYBOARD = (
     KeyboardButton.BACK
 )
 
+# (command, description) pairs, turned into BotCommand objects in handler_utils
 BOT_MAIN_COMMANDS = (
-    tt.BotCommand(command=Command.CURRENT.value, description='Get the current weather'),
-    tt.BotCommand(command=Command.TOMORROW.value, description='Get a forecast for tomorrow'),
-    tt.BotCommand(command=Command.FORECAST.value, description='Get a 4-day forecast'),
-    tt.BotCommand(command=Command.SETTINGS.value, description='Change your preferences')
+    (Command.CURRENT.value, 'Get the current weather'),
+    (Command.TOMORROW.value, 'Get a forecast for tomorrow'),
+    (Command.FORECAST.value, 'Get a 4-day forecast'),
+    (Command.SETTINGS.value, 'Change your preferences')
 )
@@ -1,40 +1,260 @@
-from collections import defaultdict
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
 
-import redis
+from consts import LOCAL_DB_PATH, REDIS_URL, REDIS_USERS_KEY, REDIS_LEGACY_KEY, REDIS_SCAN_COUNT
+from state import get_default_user_data, serialize, deserialize_line
 
-from consts import LOCAL_DB_PATH, REDIS_URL
-from state import get_default_user_data, serialize, deserialize
+# read once at import, os.umask can only be read by setting it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
 
 
-def load_from_local_db():
+def parse_raw_records(s):
+    """Maps user ids to their still serialized lines, which is much cheaper than deserializing them."""
+    return {int(line[:line.index('|')]): line for line in s.splitlines() if line}
+
+
+def load_raw_from_local_db():
     try:
         with open(LOCAL_DB_PATH, encoding='utf-8') as f:
-            data = deserialize(f.read())
+            return parse_raw_records(f.read())
     except FileNotFoundError:
-        data = {}
-    return defaultdict(lambda: get_default_user_data(), data)
+        return {}
+
 
+def migrate_redis_blob(redis_db):
+    """Moves users from the old single 'data' string into the REDIS_USERS_KEY hash."""
+    raw_data = redis_db.get(REDIS_LEGACY_KEY)
+    if raw_data is None:
+        return
+    records = list(parse_raw_records(raw_data.decode('utf-8')).items())
+    for start in range(0, len(records), REDIS_SCAN_COUNT):
+        redis_db.hset(REDIS_USERS_KEY, mapping=dict(records[start:start + REDIS_SCAN_COUNT]))
+    redis_db.rename(REDIS_LEGACY_KEY, f'{REDIS_LEGACY_KEY}:migrated')
 
-def load_db_from_redis():
+
+def load_raw_from_redis():
+    import redis
     redis_db = redis.from_url(REDIS_URL)
-    raw_data = redis_db.get('data')
-    data = deserialize(raw_data.decode('utf-8')) if raw_data is not None else {}
-    return defaultdict(lambda: get_default_user_data(), data)
+    if not redis_db.exists(REDIS_USERS_KEY):
+        migrate_redis_blob(redis_db)
+    # HSCAN may return a field twice, the dict keeps one
+    return {
+        int(user_id): line.decode('utf-8')
+        for user_id, line in redis_db.hscan_iter(REDIS_USERS_KEY, count=REDIS_SCAN_COUNT)
+    }
 
 
-def load_from_db():
+def load_raw_from_db():
     if REDIS_URL is None:
         print('Using Local DB.')
-        return load_from_local_db()
+        return load_raw_from_local_db()
     else:
         print('Using Redis.')
-        return load_db_from_redis()
+        return load_raw_from_redis()
+
+
+def save_local_db(data):
+    """Writes a new file and swaps it in, so readers never see a truncated one."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(LOCAL_DB_PATH) or None, prefix='.data-')
+    try:
+        with os.fdopen(fd, mode='w', encoding='utf-8') as f:
+            f.write(data)
+        if os.path.exists(LOCAL_DB_PATH):
+            shutil.copymode(LOCAL_DB_PATH, tmp_path)
+        else:
+            os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, LOCAL_DB_PATH)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
 
-def save_state(states):
+def save_state(states, user_id):
+    """Saves the user's state; Redis stores just that user, the local DB is rewritten whole."""
     if REDIS_URL is not None:
+        import redis
         redis_db = redis.from_url(REDIS_URL)
-        redis_db.set('data', serialize(states))
+        redis_db.hset(REDIS_USERS_KEY, user_id, serialize({user_id: states[user_id]}))
     else:
-        with open(LOCAL_DB_PATH, mode='w', encoding='utf-8') as f:
-            f.write(serialize(states))
+        save_local_db(states.serialize())
+
+
+def iter_local_db_lines():
+    try:
+        with open(LOCAL_DB_PATH, encoding='utf-8') as f:
+            for line in f:
+                yield line.rstrip('\n')
+    except FileNotFoundError:
+        return
+
+
+def iter_redis_db_lines():
+    import redis
+    redis_db = redis.from_url(REDIS_URL)
+    if not redis_db.exists(REDIS_USERS_KEY):
+        # not migrated by the bot yet
+        raw_data = redis_db.get(REDIS_LEGACY_KEY)
+        for line in io.BytesIO(raw_data or b''):
+            yield line.rstrip(b'\n').decode('utf-8')
+        return
+    seen = set()
+    for user_id, line in redis_db.hscan_iter(REDIS_USERS_KEY, count=REDIS_SCAN_COUNT):
+        # HSCAN may return a field twice
+        if user_id not in seen:
+            seen.add(user_id)
+            yield line.decode('utf-8')
+
+
+def iter_user_records():
+    """Yields (user_id, user_data) from the stored user base without loading all of it.
+
+    Redis is streamed with HSCAN, REDIS_SCAN_COUNT users at a time, and each user is saved
+    as its own field, so a concurrent save can't corrupt a record. The local DB file is read
+    line by line and replaced atomically on save. Malformed lines are reported and skipped.
+    """
+    lines = iter_local_db_lines() if REDIS_URL is None else iter_redis_db_lines()
+    for line in lines:
+        if not line:
+            continue
+        try:
+            yield deserialize_line(line)
+        except (ValueError, NotImplementedError) as e:
+            sys.stderr.write(f"Skipping malformed user record: {e}" + os.linesep)
+
+
+class LazyStates:
+    """User states for the bot, loaded so that it can start polling right away.
+
+    The serialized records are read in a background thread, and each user is only
+    deserialized the first time it's accessed. Access blocks until the records are read.
+    Unknown users get the default user data, like with a defaultdict, but they only
+    count as known users once their data differs from the default.
+    """
+
+    def __init__(self, loader=load_raw_from_db):
+        self._loader = loader
+        self._raw = None  # user id -> serialized line of users not accessed yet
+        self._users = {}
+        self._new_users = {}  # unknown users handed out with the default data
+        self._default = get_default_user_data()
+        self._loaded = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start_loading(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._load, name='states-loader', daemon=True)
+                self._thread.start()
+
+    def is_loaded(self):
+        return self._loaded.is_set() and self._raw is not None
+
+    def _load(self):
+        try:
+            self._raw = self._loader()
+        except Exception as e:
+            sys.stderr.write(f"Exception: {e}" + os.linesep)
+        finally:
+            self._loaded.set()
+
+    def _get_raw(self):
+        if not self._loaded.is_set():
+            self.start_loading()
+            self._loaded.wait()
+        if self._raw is None:
+            # background load failed, retry in the caller so the error surfaces there
+            with self._lock:
+                if self._raw is None:
+                    self._raw = self._loader()
+        return self._raw
+
+    def _changed_new_users(self):
+        return [(user_id, user_data) for user_id, user_data in list(self._new_users.items())
+                if user_data != self._default]
+
+    def __getitem__(self, user_id):
+        user_data = self._users.get(user_id) or self._new_users.get(user_id)
+        if user_data is not None:
+            return user_data
+        raw = self._get_raw()
+        with self._lock:
+            user_data = self._users.get(user_id) or self._new_users.get(user_id)
+            if user_data is None:
+                line = raw.pop(user_id, None)
+                if line is not None:
+                    user_data = deserialize_line(line)[1]
+                    self._users[user_id] = user_data
+                else:
+                    user_data = get_default_user_data()
+                    self._new_users[user_id] = user_data
+        return user_data
+
+    def __contains__(self, user_id):
+        if user_id in self._users or user_id in self._get_raw():
+            return True
+        user_data = self._new_users.get(user_id)
+        return user_data is not None and user_data != self._default
+
+    def __iter__(self):
+        return iter([user_id for user_id, _ in self.iter_records()])
+
+    def __len__(self):
+        raw = self._get_raw()
+        with self._lock:
+            return len(self._users) + len(raw) + len(self._changed_new_users())
+
+    def items(self):
+        """Returns a list of all (user_id, user_data) pairs, deserializing every remaining user."""
+        for user_id in list(self._get_raw()):
+            self[user_id]
+        with self._lock:
+            return list(self._users.items()) + self._changed_new_users()
+
+    def iter_records(self):
+        """Yields (user_id, user_data) for a snapshot of the known users' ids without keeping
+        the deserialized ones. Users accessed meanwhile are neither dropped nor repeated."""
+        raw = self._get_raw()
+        with self._lock:
+            user_ids = list(self._users) + list(raw) + [user_id for user_id, _ in self._changed_new_users()]
+        for user_id in user_ids:
+            with self._lock:
+                user_data = self._users.get(user_id) or self._new_users.get(user_id)
+                line = raw.get(user_id) if user_data is None else None
+            if user_data is not None:
+                yield user_id, user_data
+            elif line is not None:
+                try:
+                    yield deserialize_line(line)
+                except (ValueError, NotImplementedError) as e:
+                    sys.stderr.write(f"Skipping malformed user record: {e}" + os.linesep)
+
+    def iter_locations(self):
+        """Yields every known user's location without deserializing anyone."""
+        raw = self._get_raw()
+        with self._lock:
+            users = list(self._users.values()) + [user_data for _, user_data in self._changed_new_users()]
+            lines = list(raw.values())
+        for user_data in users:
+            yield user_data.settings.location
+        for line in lines:
+            yield line.split('|', 3)[2]
+
+    def serialize(self):
+        raw = self._get_raw()
+        with self._lock:
+            users = dict(self._users)
+            users.update(self._changed_new_users())
+            lines = list(raw.values())
+        if users:
+            lines.append(serialize(users))
+        return '\n'.join(lines)
+
+
+# Shared by handlers and weather_bot, which starts loading before the slow telebot import
+states = LazyStates()
@@ -1,12 +1,18 @@
+import os
 import random
+import tempfile
+import threading
+import time
+from collections import Counter
 
 from telebot import types as tt
 
 import handlers
+from admin import compute_stats, export_users
 from api import *
 from consts import *
 from db import save_state
-from state import State
+from state import State, get_default_user_data
 
 
 def remove_reply_keyboard():
@@ -51,12 +57,12 @@ def get_select_units_keyboard():
 
 
 def set_bot_commands(commands=()):
-    handlers.bot.set_my_commands(commands)
+    handlers.bot.set_my_commands([tt.BotCommand(command=c, description=d) for c, d in commands])
 
 
 def switch_to_state(user_id, state):
     handlers.states[user_id].state = state
-    save_state(handlers.states)
+    save_state(handlers.states, user_id)
     if state == State.SETTINGS:
         show_settings_keyboard(user_id)
     elif state == State.MAIN:
@@ -145,52 +151,245 @@ def reply_to_bad_command(message):
     handlers.bot.reply_to(message, random.choice(BAD_COMMAND_ANSWERS))
 
 
-def get_current_weather(user_id):
+def render_current_weather(location_data, report, units):
+    return f"<i>Current weather in {location_data.city}, {location_data.country}: " \
+           f"{report.temp}{DEGREE_SIGNS[units]}, {report.desc}</i>"
+
+
+def render_current_weather_report(response, units):
+    location_data, report = get_current_weather_from_response(response)
+    if location_data is None:
+        return None
+    return render_current_weather(location_data, report, units)
+
+
+def render_tomorrow_weather_report(response, units):
+    location_data, reports = get_tomorrow_weather_from_response(response)
+    if location_data is None:
+        return None
+    lines = [f"<u>{reports[0].datetime.strftime('%B %d')} - {location_data.city}, {location_data.country}:</u>"]
+    for report in reports:
+        lines.append(
+            f"<i><b>{report.datetime.strftime('%H:%M')}</b>: "
+            f"{report.temp}{DEGREE_SIGNS[units]}, {report.desc}</i>")
+    return '\n'.join(lines)
+
+
+def render_forecast_report(response, units):
+    location_data, reports = get_forecast_from_response(response)
+    if location_data is None:
+        return None
+    lines = [f'<u>4-day forecast for {location_data.city}, {location_data.country}:</u>']
+    for report in reports:
+        lines.append(
+            f"<i><b>{report.date.strftime('%b %d')}</b>: {report.min}-{report.max}{DEGREE_SIGNS[units]}, "
+            f"{report.desc}</i>")
+    return '\n'.join(lines)
+
+
+def message_size(message):
+    return len(message.encode('utf-8'))
+
+
+def get_rendered_report(entry, kind, render, units, size=message_size):
+    """Returns the report rendered from the cached forecast entry, rendering it only once per forecast."""
+    key = (kind, entry.response['list'][0]['dt'])
+    return get_rendered(entry, key, lambda response: render(response, units), size)
+
+
+def send_report(user_id, kind, render):
     handlers.bot.send_chat_action(user_id, 'typing')
     settings = handlers.states[user_id].settings
-    response = request_forecast(settings.location, settings.language, settings.units)
-    if response is not None:
-        location_data, report = get_current_weather_from_response(response)
-        if location_data is not None:
-            units = handlers.states[user_id].settings.units
-            message = f"<i>Current weather in {location_data.city}, {location_data.country}: " \
-                      f"{report.temp}{DEGREE_SIGNS[units]}, {report.desc}</i>"
+    entry = request_forecast_entry(settings.location, settings.language, settings.units)
+    if entry is not None:
+        message = get_rendered_report(entry, kind, render, settings.units)
+        if message is not None:
             handlers.bot.send_message(user_id, message, parse_mode='HTML')
             return
     handlers.bot.send_message(user_id, '⁉️ Server error. Please try again.')
 
 
+def get_current_weather(user_id):
+    send_report(user_id, 'current', render_current_weather_report)
+
+
 def get_tomorrow_weather(user_id):
-    handlers.bot.send_chat_action(user_id, 'typing')
-    settings = handlers.states[user_id].settings
-    response = request_forecast(settings.location, settings.language, settings.units)
-    if response is not None:
-        units = handlers.states[user_id].settings.units
-        location_data, reports = get_tomorrow_weather_from_response(response)
-        if location_data is not None:
-            lines = [f"<u>{reports[0].datetime.strftime('%B %d')} - {location_data.city}, {location_data.country}:</u>"]
-            for report in reports:
-                lines.append(
-                    f"<i><b>{report.datetime.strftime('%H:%M')}</b>: "
-                    f"{report.temp}{DEGREE_SIGNS[units]}, {report.desc}</i>")
-            handlers.bot.send_message(user_id, '\n'.join(lines), parse_mode='HTML')
-            return
-    handlers.bot.send_message(user_id, '⁉️ Server error. Please try again.')
+    send_report(user_id, 'tomorrow', render_tomorrow_weather_report)
 
 
 def get_forecast(user_id):
-    handlers.bot.send_chat_action(user_id, 'typing')
-    settings = handlers.states[user_id].settings
-    response = request_forecast(settings.location, settings.language, settings.units)
-    if response is not None:
-        units = handlers.states[user_id].settings.units
-        location_data, reports = get_forecast_from_response(response)
-        if location_data is not None:
-            lines = [f'<u>4-day forecast for {location_data.city}, {location_data.country}:</u>']
-            for report in reports:
-                lines.append(
-                    f"<i><b>{report.date.strftime('%b %d')}</b>: {report.min}-{report.max}{DEGREE_SIGNS[units]}, "
-                    f"{report.desc}</i>")
-            handlers.bot.send_message(user_id, '\n'.join(lines), parse_mode='HTML')
-            return
-    handlers.bot.send_message(user_id, '⁉️ Server error. Please try again.')
+    send_report(user_id, 'forecast', render_forecast_report)
+
+
+_popular_locations = []
+
+
+def get_popular_locations():
+    return _popular_locations
+
+
+def update_popular_locations():
+    global _popular_locations
+    counter = Counter(handlers.states.iter_locations())
+    counter.pop('', None)
+    _popular_locations = [location for location, _ in counter.most_common()]
+
+
+def warm_up_popular_locations():
+    """Fetches the most popular locations in every language and units under the bulk share of the quota,
+    and renders their inline answers in advance."""
+    locations = get_popular_locations()[:POPULAR_LOCATIONS_WARM_UP]
+    for language in Language:
+        for units in Units:
+            for location, _ in request_forecasts(locations, language, units):
+                entry = get_cached_forecast_entry(location, language, units)
+                if entry is not None:
+                    get_rendered_report(entry, 'inline', render_inline_query_result, units, inline_result_size)
+
+
+def _keep_popular_locations_updated():
+    while True:
+        try:
+            update_popular_locations()
+            warm_up_popular_locations()
+        except Exception as e:
+            sys.stderr.write(f"Exception: {e}" + os.linesep)
+        time.sleep(POPULAR_LOCATIONS_UPDATE_INTERVAL)
+
+
+def start_popular_locations_updates():
+    """Recounts and warms up the subscribers' locations in the background, inline queries use the last count."""
+    threading.Thread(target=_keep_popular_locations_updated, name='popular-locations', daemon=True).start()
+
+
+def get_inline_settings(user_id):
+    # don't keep inline queries waiting for the user base to load
+    if handlers.states.is_loaded() and user_id in handlers.states:
+        return handlers.states[user_id].settings
+    return get_default_user_data().settings
+
+
+def render_inline_query_result(response, units):
+    location_data, report = get_current_weather_from_response(response)
+    if location_data is None:
+        return None
+    return tt.InlineQueryResultArticle(
+        id=f'{location_data.city}|{location_data.country}',
+        title=f'{location_data.city}, {location_data.country}',
+        description=f'{report.temp}{DEGREE_SIGNS[units]}, {report.desc}',
+        input_message_content=tt.InputTextMessageContent(
+            message_text=render_current_weather(location_data, report, units),
+            parse_mode='HTML'
+        )
+    )
+
+
+def inline_result_size(result):
+    return sum(message_size(text) for text in (
+        result.id, result.title, result.description, result.input_message_content.message_text
+    ))
+
+
+def get_inline_query_results(query_text, settings, fetch=False):
+    """Builds inline results for the query from cached forecasts only, unless fetch is set.
+
+    Returns the results and the typed location if its forecast isn't cached yet.
+    """
+    prefix = query_text.strip().lower()
+    candidates = [location for location in get_popular_locations() if location.lower().startswith(prefix)]
+    if prefix and prefix not in (location.lower() for location in candidates):
+        candidates.insert(0, query_text.strip().title())
+    results = []
+    missing = None
+    ids = set()
+    for location in candidates:
+        if len(results) == INLINE_MAX_RESULTS:
+            break
+        if fetch and location.lower() == prefix:
+            entry = request_forecast_entry(location, settings.language, settings.units)
+        else:
+            entry = get_cached_forecast_entry(location, settings.language, settings.units)
+        if entry is None:
+            if location.lower() == prefix:
+                missing = location
+            continue
+        result = get_rendered_report(entry, 'inline', render_inline_query_result, settings.units, inline_result_size)
+        if result is not None and result.id not in ids:
+            ids.add(result.id)
+            results.append(result)
+    return results, missing
+
+
+def answer_inline_query(query, results):
+    handlers.bot.answer_inline_query(query.id, results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+
+
+_inline_timers = {}
+_inline_timers_lock = threading.Lock()
+
+
+def debounce_inline_query(query, settings):
+    """Fetches the forecast for the query once the user has stopped typing.
+
+    A newer query from the same user cancels the pending one.
+    """
+    user_id = query.from_user.id
+    timer = threading.Timer(INLINE_DEBOUNCE_DELAY, _answer_debounced_inline_query, (query, settings))
+    timer.daemon = True
+    with _inline_timers_lock:
+        previous = _inline_timers.get(user_id)
+        if previous is not None:
+            previous.cancel()
+        _inline_timers[user_id] = timer
+    timer.start()
+
+
+def _answer_debounced_inline_query(query, settings):
+    with _inline_timers_lock:
+        if _inline_timers.get(query.from_user.id) is threading.current_thread():
+            del _inline_timers[query.from_user.id]
+    results, _ = get_inline_query_results(query.query, settings, fetch=True)
+    try:
+        answer_inline_query(query, results)
+    except Exception as e:
+        sys.stderr.write(f"Exception: {e}" + os.linesep)
+
+
+def run_in_background(func, *args):
+    threading.Thread(target=func, args=args, daemon=True).start()
+
+
+def run_admin_report(user_id, func, *args):
+    """Runs the report in the background, telling the admin if it fails."""
+    run_in_background(_run_admin_report, user_id, func, *args)
+
+
+def _run_admin_report(user_id, func, *args):
+    try:
+        func(user_id, *args)
+    except Exception as e:
+        sys.stderr.write(f"Exception: {e}" + os.linesep)
+        handlers.bot.send_message(user_id, f'⁉️ Report failed: {e}')
+
+
+def send_admin_stats(user_id):
+    stats = compute_stats(handlers.states.iter_records())
+    cache_stats = get_render_cache_stats()
+    lines = [
+        stats.summary(),
+        f'Cached forecasts: {len(get_forecast_cache_entries())}',
+        f"Rendered cache: {cache_stats['entries']} entries, {cache_stats['bytes']} bytes, "
+        f"{cache_stats['hits']} hits, {cache_stats['misses']} misses",
+    ]
+    handlers.bot.send_message(user_id, '\n'.join(lines))
+
+
+def send_admin_export(user_id, fmt):
+    with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', newline='', suffix=f'.{fmt}',
+                                     prefix='users-', delete=False) as f:
+        count = export_users(f, fmt, handlers.states.iter_records())
+    try:
+        with open(f.name, mode='rb') as document:
+            handlers.bot.send_document(user_id, document, caption=f'{count} users')
+    finally:
+        os.remove(f.name)
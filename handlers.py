@@ -1,14 +1,15 @@
 import telebot
 
-from db import load_from_db, save_state
+from db import states
 from handler_utils import *
 from state import State
 
 bot = telebot.TeleBot(TOKEN)
-states = load_from_db()
 
 
 def start_polling():
+    states.start_loading()
+    start_popular_locations_updates()
     bot.polling(none_stop=True)
 
 
@@ -60,6 +61,16 @@ def setting_units_callback_handler(call):
     switch_to_state(user_id, State.SETTINGS)
 
 
+@bot.inline_handler(func=lambda query: True)
+def inline_query_handler(query):
+    settings = get_inline_settings(query.from_user.id)
+    results, missing = get_inline_query_results(query.query, settings)
+    if results or missing is None:
+        answer_inline_query(query, results)
+    else:
+        debounce_inline_query(query, settings)
+
+
 @bot.message_handler(commands=['start'])
 def send_welcome(message):
     set_bot_commands()
@@ -73,6 +84,21 @@ def send_welcome(message):
     switch_to_state(user_id, State.WELCOME)
 
 
+@bot.message_handler(commands=['stats'], func=lambda message: message.from_user.id in ADMIN_IDS)
+def admin_stats_handler(message):
+    run_admin_report(message.from_user.id, send_admin_stats)
+
+
+@bot.message_handler(commands=['export'], func=lambda message: message.from_user.id in ADMIN_IDS)
+def admin_export_handler(message):
+    args = message.text.split()[1:]
+    fmt = args[0].lower() if args else 'csv'
+    if fmt not in ('csv', 'jsonl'):
+        bot.reply_to(message, 'Usage: /export [csv|jsonl]')
+        return
+    run_admin_report(message.from_user.id, send_admin_export, fmt)
+
+
 @bot.message_handler(func=lambda message: states[message.from_user.id].state == State.WELCOME)
 def welcome_handler(message):
     user_id = message.from_user.id
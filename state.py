@@ -90,19 +90,24 @@ def serialize(states):
     return '\n'.join(lines)
 
 
+def deserialize_line(line):
+    id_, state, loc, lang, units = line.split('|')
+    return int(id_), UserData(
+        state=State.from_int(int(state)),
+        settings=Settings(
+            location=loc,
+            language=Language.from_str(lang),
+            units=Units.from_str(units)
+        )
+    )
+
+
 def deserialize(s):
     states = {}
     lines = s.splitlines()
     for line in lines:
-        id_, state, loc, lang, units = line.split('|')
-        states[int(id_)] = UserData(
-            state=State.from_int(int(state)),
-            settings=Settings(
-                location=loc,
-                language=Language.from_str(lang),
-                units=Units.from_str(units)
-            )
-        )
+        id_, user_data = deserialize_line(line)
+        states[id_] = user_data
     return states
 
 
@@ -0,0 +1,142 @@
+import json
+import threading
+import time
+from collections import Counter
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+import api
+from state import Language, Units
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubOWMHandler(BaseHTTPRequestHandler):
+    requests_by_location = Counter()
+
+    def do_GET(self):
+        location = parse_qs(urlparse(self.path).query)['q'][0]
+        self.requests_by_location[location.lower()] += 1
+        if location == 'nowhere':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = b'<html>bad gateway</html>' if location == 'broken' else json.dumps({
+            'city': {'name': location.title(), 'country': 'XX', 'timezone': 0},
+            'list': [],
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def owm_stub(monkeypatch):
+    monkeypatch.setenv('NO_PROXY', '127.0.0.1')
+    monkeypatch.setattr(api, '_forecast_cache', {})
+    StubOWMHandler.requests_by_location = Counter()
+    server = StubServer(('127.0.0.1', 0), StubOWMHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/forecast'
+    server.shutdown()
+    server.server_close()
+
+
+def test_request_forecasts(owm_stub):
+    locations = [f'city{i}' for i in range(20)] + ['City1', 'nowhere', 'broken']
+    quota = api.RateLimiter(1000)
+
+    results = dict(api.request_forecasts(locations, Language.ENGLISH, Units.METRIC, api_url=owm_stub, quota=quota))
+    assert len(results) == 22
+    assert results['nowhere'] is None
+    assert results['broken'] is None
+    assert results['city1']['city']['name'] == 'City1'
+    assert StubOWMHandler.requests_by_location['city1'] == 1
+
+    fetched = sum(StubOWMHandler.requests_by_location.values())
+    results = dict(api.request_forecasts(locations, Language.ENGLISH, Units.METRIC, api_url=owm_stub, quota=quota))
+    assert sum(response is not None for response in results.values()) == 20
+    # only the failed ones are fetched again
+    assert sum(StubOWMHandler.requests_by_location.values()) == fetched + 2
+
+
+def forecast(city, dt=0):
+    return {'city': {'name': city, 'country': 'XX', 'timezone': 0}, 'list': [{'dt': dt}]}
+
+
+def test_rendered_output_is_reused_and_dropped_with_its_forecast(monkeypatch):
+    monkeypatch.setattr(api, '_forecast_cache', {})
+    monkeypatch.setattr(api, 'FORECAST_CACHE_SIZE', 1)
+    renders = []
+
+    def render(response):
+        renders.append(response)
+        return response['city']['name']
+
+    def get_rendered(location):
+        entry = api.get_cached_forecast_entry(location, Language.ENGLISH, Units.METRIC)
+        return api.get_rendered(entry, ('current', entry.response['list'][0]['dt']), render, len)
+
+    stats = api.get_render_cache_stats()
+    api.store_forecast('London', Language.ENGLISH, Units.METRIC, forecast('London'))
+    assert get_rendered('London') == 'London'
+    assert get_rendered('london') == 'London'
+    assert len(renders) == 1
+    after = api.get_render_cache_stats()
+    assert (after['entries'], after['bytes']) == (1, len('London'))
+    assert (after['hits'] - stats['hits'], after['misses'] - stats['misses']) == (1, 1)
+
+    # refetched forecast
+    api.store_forecast('London', Language.ENGLISH, Units.METRIC, forecast('London'))
+    assert get_rendered('London') == 'London'
+    assert len(renders) == 2
+
+    # evicted forecast
+    api.store_forecast('Paris', Language.ENGLISH, Units.METRIC, forecast('Paris'))
+    assert api.get_cached_forecast_entry('London', Language.ENGLISH, Units.METRIC) is None
+    assert api.get_render_cache_stats()['entries'] == 0
+
+
+def test_rate_limiter_window_and_reserve():
+    limiter = api.RateLimiter(4, period=0.3)
+    start = time.monotonic()
+    for _ in range(2):
+        limiter.acquire(reserve=2)
+    assert time.monotonic() - start < 0.1
+    # bulk callers leave the reserved calls to the others
+    limiter.acquire()
+    limiter.acquire()
+    assert time.monotonic() - start < 0.1
+    limiter.acquire(reserve=2)
+    assert time.monotonic() - start >= 0.3
+
+
+def test_rate_limiter_timeout():
+    limiter = api.RateLimiter(1, period=10)
+    assert limiter.acquire(timeout=0.1)
+    start = time.monotonic()
+    assert not limiter.acquire(timeout=0.1)
+    assert time.monotonic() - start < 0.1
+
+
+def test_request_forecasts_stops_waiting_when_closed(owm_stub):
+    locations = [f'city{i}' for i in range(20)]
+    stream = api.request_forecasts(locations, Language.ENGLISH, Units.METRIC, workers=4, api_url=owm_stub,
+                                   quota=api.RateLimiter(2, period=60))
+    next(stream)
+    start = time.monotonic()
+    stream.close()
+    assert time.monotonic() - start < 0.5
+    fetched = sum(StubOWMHandler.requests_by_location.values())
+    time.sleep(1)
+    # the fetches left waiting for the quota were dropped
+    assert sum(StubOWMHandler.requests_by_location.values()) == fetched < len(locations)
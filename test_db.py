@@ -0,0 +1,172 @@
+import os
+import stat
+import threading
+
+import pytest
+
+import db
+from db import LazyStates, parse_raw_records
+from state import State, Language, get_default_user_data, deserialize
+
+LINES = (
+    '1|0|London|english|metric',
+    '2|2|Москва|russian|imperial',
+    '3|1||english|metric',
+)
+
+
+def raw_loader():
+    return parse_raw_records('\n'.join(LINES))
+
+
+def test_unknown_users_get_default_data():
+    states = LazyStates(raw_loader)
+    assert states[42] == get_default_user_data()
+    assert 42 not in states
+    assert len(states) == 3
+    assert 42 not in dict(states.items())
+
+    states[42].settings.location = 'Paris'
+    assert 42 in states
+    assert len(states) == 4
+
+
+def test_serialize_keeps_untouched_lines_and_modified_users():
+    states = LazyStates(raw_loader)
+    states[1].settings.language = Language.RUSSIAN
+    states[3]
+    states[99].state = State.MAIN
+
+    serialized = states.serialize()
+    assert LINES[1] in serialized.splitlines()
+    decoded = deserialize(serialized)
+    assert set(decoded) == {1, 2, 3, 99}
+    assert decoded[1].settings.language == Language.RUSSIAN
+    assert decoded[1].settings.location == 'London'
+    assert decoded[3] == states[3]
+    assert decoded[99].state == State.MAIN
+
+
+def test_failed_background_load_is_retried_in_caller():
+    calls = []
+
+    def flaky_loader():
+        calls.append(1)
+        if len(calls) == 1:
+            raise ConnectionError('redis is down')
+        return raw_loader()
+
+    states = LazyStates(flaky_loader)
+    states.start_loading()
+    states._thread.join()
+    assert not states.is_loaded()
+    assert states[2].settings.location == 'Москва'
+    assert len(calls) == 2
+    assert states.is_loaded()
+
+
+def test_failed_retry_surfaces_in_caller():
+    def broken_loader():
+        raise ConnectionError('redis is down')
+
+    states = LazyStates(broken_loader)
+    with pytest.raises(ConnectionError):
+        states[1]
+
+
+def test_iter_locations():
+    states = LazyStates(raw_loader)
+    states[1].settings.location = 'Paris'
+    states[42]
+    states[43].settings.location = 'Oslo'
+    assert sorted(states.iter_locations()) == ['', 'Oslo', 'Paris', 'Москва']
+
+
+def test_iter_records_during_concurrent_access():
+    users = 20000
+    states = LazyStates(lambda: parse_raw_records('\n'.join(f'{i}|0|City{i % 7}|english|metric'
+                                                            for i in range(users))))
+    states[0]
+    stop = threading.Event()
+
+    def access():
+        user_id = users - 1
+        while not stop.is_set() and user_id >= 0:
+            states[user_id]
+            user_id -= 1
+
+    accessor = threading.Thread(target=access)
+    accessor.start()
+    try:
+        user_ids = [user_id for user_id, _ in states.iter_records()]
+    finally:
+        stop.set()
+        accessor.join()
+    assert len(user_ids) == users
+    assert set(user_ids) == set(range(users))
+
+
+class FakeRedis:
+    def __init__(self, data):
+        self.data = dict(data)
+
+    def exists(self, key):
+        return key in self.data
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def rename(self, key, new_key):
+        self.data[new_key] = self.data.pop(key)
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        fields = self.data.setdefault(key, {})
+        for field, value in (mapping or {field: value}).items():
+            fields[str(field).encode('utf-8')] = str(value).encode('utf-8')
+
+    def hscan_iter(self, key, count=None):
+        return iter(list(self.data.get(key, {}).items()))
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    import redis
+    fake = FakeRedis({'data': '\n'.join(LINES).encode('utf-8')})
+    monkeypatch.setattr(redis, 'from_url', lambda url: fake)
+    monkeypatch.setattr(db, 'REDIS_URL', 'redis://stub')
+    return fake
+
+
+def test_redis_users_are_migrated_to_a_hash_and_saved_one_by_one(fake_redis):
+    states = LazyStates(db.load_raw_from_redis)
+    assert len(states) == 3
+    assert 'data' not in fake_redis.data
+    assert len(fake_redis.data['users']) == 3
+
+    states[2].state = State.MAIN
+    db.save_state(states, 2)
+    assert fake_redis.data['users'][b'2'].decode('utf-8') == '2|0|Москва|russian|imperial'
+    assert fake_redis.data['users'][b'1'] == LINES[0].encode('utf-8')
+    assert [user_id for user_id, _ in db.iter_user_records()] == [1, 2, 3]
+
+
+def test_local_db_save_keeps_file_mode(tmp_path, monkeypatch):
+    path = tmp_path / 'data'
+    path.write_text('\n'.join(LINES), encoding='utf-8')
+    os.chmod(path, 0o644)
+    monkeypatch.setattr(db, 'LOCAL_DB_PATH', str(path))
+    states = LazyStates(db.load_raw_from_local_db)
+    states[1].settings.location = 'Paris'
+    db.save_state(states, 1)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+    assert [user_data.settings.location for _, user_data in db.iter_user_records()].count('Paris') == 1
+
+
+def test_failed_local_db_save_leaves_no_temp_file(tmp_path, monkeypatch):
+    path = tmp_path / 'data'
+    path.write_text(LINES[0], encoding='utf-8')
+    monkeypatch.setattr(db, 'LOCAL_DB_PATH', str(path))
+    with pytest.raises(TypeError):
+        db.save_local_db(None)
+    assert os.listdir(tmp_path) == ['data']
+    assert path.read_text(encoding='utf-8') == LINES[0]
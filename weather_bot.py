@@ -2,7 +2,7 @@ import os
 import sys
 
 from consts import TOKEN, OWM_API_KEY, REDIS_URL
-from handlers import start_polling
+from db import states
 
 if __name__ == '__main__':
     if TOKEN is None:
@@ -13,4 +13,7 @@ if __name__ == '__main__':
         sys.exit(1)
     if REDIS_URL is None:
         sys.stderr.write('Warning: REDIS_URL is not set, using local DB.' + os.linesep)
+    # Load users while telebot (and the redis client it pulls in) is being imported
+    states.start_loading()
+    from handlers import start_polling
     start_polling()